@@ -20,13 +20,19 @@ References:
 """
 
 import os
-import re
-import json
+import atexit
+import hashlib
+import orjson
 import uuid
 import time
 import queue
 import threading
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import serial
 import sys
 import csv
@@ -34,23 +40,6 @@ from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
-# Open (or create) the log file for appending
-_log = open("terminal_output.log", "a", buffering=1, encoding="utf-8")
-
-class _Tee:
-    def __init__(self, *streams):
-        self.streams = streams
-    def write(self, data):
-        for s in self.streams:
-            s.write(data)
-    def flush(self):
-        for s in self.streams:
-            s.flush()
-
-# Replace stdout and stderr with our Tee
-sys.stdout = _Tee(sys.stdout, _log)
-sys.stderr = _Tee(sys.stderr, _log)
-
 # ─── CONFIGURATION ───
 SERIAL_PORTS    = ['COM3', 'COM4']
 BAUDRATE        = 9600
@@ -59,6 +48,7 @@ PARITY          = serial.PARITY_NONE
 STOPBITS        = serial.STOPBITS_ONE
 RTSCTS          = True
 TIMEOUT         = 1  # seconds
+TERMINAL_LOG    = 'terminal_output.log'
 
 IDENTITY_URL    = 'https://identity-qa.go360iq.com/connect/token'
 CLIENT_ID       = 'externalPartner_NSRPetrol'
@@ -72,27 +62,108 @@ LOG_DIR         = 'logs'
 EVENTS_DIR      = 'events'
 TRANSACTIONS_DIR= 'transactions'
 CSV_REPORT      = '360iQDataAPI-AcceptanceReport.csv'
-HEADER_PATTERN  = re.compile(r'mlen=(\d+)$')
+CSV_FLUSH_SECS  = 5  # max seconds buffered CSV rows wait before a flush
+HEADER_PREFIX   = b'mlen='  # header line is mlen=<payload byte count>
+MONEY_STRIP     = str.maketrans('', '', '$,')  # currency formatting removed before float()
+DISPATCH_WORKERS= 8   # parallel POSTs to the Data API
+MAX_IN_FLIGHT   = 32  # submitted-but-unfinished transactions before the dispatcher waits
+
+# Money rounding, built once instead of per quantize() call
+_Q2             = Decimal('0.01')
+_HALF_UP        = ROUND_HALF_UP
+
+# Namespace prefix for the UUIDv5 transaction GUIDs
+_NS_BYTES       = uuid.NAMESPACE_URL.bytes
 
 # Queues and token cache
 tx_queue      = queue.Queue()
 parser_queue  = queue.Queue()
+_io_queue     = queue.Queue(maxsize=1024)  # (fn, args) disk writes drained by io_worker
+_csv_fh       = None
+_csv_writer   = None
 _token_data   = {'access_token': None, 'expires_at': 0.0}
+_token_lock   = threading.RLock()  # re-entered by fetch_token() under refresh_token_now()
+_token_cond   = threading.Condition()  # notified to make token_refresher reschedule
+
+# Data API headers that never change; the body is sent pre-encoded as JSON bytes
+API_HEADERS   = {'External-Party-ID': CLIENT_ID, 'Content-Type': 'application/json'}
+
+# Shared HTTP session so token and data API calls reuse pooled keep-alive connections
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=DISPATCH_WORKERS,
+                                       max_retries=Retry(total=3, backoff_factor=0.5)))
+
+_executor     = ThreadPoolExecutor(max_workers=DISPATCH_WORKERS, thread_name_prefix='dispatch')
+_in_flight    = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+# ─── LOGGING ───
+
+def setup_logging():
+    """Send log records through a queue so callers never block on console or file I/O."""
+    log_q = queue.Queue(-1)
+    fmt = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+    console = logging.StreamHandler(sys.stdout)
+    logfile = logging.FileHandler(TERMINAL_LOG, encoding='utf-8')
+    console.setFormatter(fmt)
+    logfile.setFormatter(fmt)
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    root.addHandler(QueueHandler(log_q))
+    listener = QueueListener(log_q, console, logfile)
+    listener.start()
+    atexit.register(listener.stop)
+    # Tracebacks went to the log file via the old stderr tee; keep that for crashes
+    sys.excepthook = _log_uncaught
+    threading.excepthook = _log_thread_crash
+
+
+def _log_uncaught(exc_type, exc, tb):
+    if issubclass(exc_type, KeyboardInterrupt):
+        sys.__excepthook__(exc_type, exc, tb)
+        return
+    logging.critical("Uncaught exception", exc_info=(exc_type, exc, tb))
+
+
+def _log_thread_crash(args):
+    if args.exc_type is SystemExit:
+        return
+    logging.critical("Uncaught exception in thread %s",
+                     args.thread.name if args.thread else '?',
+                     exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
 
 # ─── DIRECTORY UTILITIES ───
 
+_made_dirs = set()
+
+def _ensure_dir(path: str):
+    """os.makedirs once per path for the life of the process."""
+    if path not in _made_dirs:
+        os.makedirs(path, exist_ok=True)
+        _made_dirs.add(path)
+
+
 def ensure_directories():
-    os.makedirs(LOG_DIR, exist_ok=True)
-    os.makedirs(EVENTS_DIR, exist_ok=True)
-    os.makedirs(TRANSACTIONS_DIR, exist_ok=True)
+    _ensure_dir(LOG_DIR)
+    _ensure_dir(EVENTS_DIR)
+    _ensure_dir(TRANSACTIONS_DIR)
+
+
+def open_csv_report():
+    """Open the acceptance CSV once for the life of the process, writing the header if new."""
+    global _csv_fh, _csv_writer
+    file_exists = os.path.isfile(CSV_REPORT)
+    _csv_fh = open(CSV_REPORT, 'a', newline='', encoding='utf-8', buffering=8192)
+    _csv_writer = csv.writer(_csv_fh)
+    if not file_exists:
+        _csv_writer.writerow(['ts_utc', 'guid', 'store', 'terminal', 'seq', 'type', 'result', 'status_code'])
+    atexit.register(_csv_fh.flush)
 
 # ─── AUTHENTICATION ───
 
 def fetch_token() -> str:
+    """Fetch a fresh token from the identity service and publish it in _token_data."""
     now = time.time()
-    if _token_data['access_token'] and (_token_data['expires_at'] - 60) > now:
-        return _token_data['access_token']
-    resp = requests.post(
+    resp = _session.post(
         IDENTITY_URL,
         data={
             'grant_type': 'client_credentials',
@@ -104,9 +175,46 @@ def fetch_token() -> str:
     resp.raise_for_status()
     js = resp.json()
     token = js['access_token']
-    _token_data['access_token'] = token
-    _token_data['expires_at']  = now + js.get('expires_in', 3600)
-    print(f"[INFO] Fetched new token; expires in {js.get('expires_in',3600)}s.")
+    with _token_lock:
+        _token_data['access_token'] = token
+        _token_data['expires_at']  = now + js.get('expires_in', 3600)
+    logging.info("Fetched new token; expires in %ss.", js.get('expires_in',3600))
+    return token
+
+
+def token_refresher():
+    """Keep _token_data fresh in the background so dispatch never waits on the identity API.
+
+    Waking early (after a 401 refresh) only reschedules from the new expiry; it never fetches.
+    """
+    next_try = 0.0  # earliest time to fetch again: 60s after success, 30s after failure
+    while True:
+        due = max(_token_data['expires_at'] - 300, next_try)
+        now = time.time()
+        if now < due:
+            with _token_cond:
+                _token_cond.wait(timeout=due - now)
+            continue
+        try:
+            fetch_token()
+            next_try = time.time() + 60
+        except Exception as e:
+            logging.error("Token refresh failed: %s. Retrying in 30s...", e)
+            next_try = time.time() + 30
+
+
+def refresh_token_now(stale_token) -> str:
+    """Replace stale_token after a 401, unless another sender already has.
+
+    Concurrent 401s for the same token result in a single identity call; token_refresher
+    is then woken so it reschedules from the new expiry.
+    """
+    with _token_lock:
+        if _token_data['access_token'] != stale_token:
+            return _token_data['access_token']
+        token = fetch_token()
+    with _token_cond:
+        _token_cond.notify()
     return token
 
 # ─── TIMESTAMP & GUID ───
@@ -122,55 +230,94 @@ def to_utc(local_ts: str) -> str:
         if dt.year < 2023:
             # Use current time instead
             dt = datetime.now(tz)
-            print(f"[INFO] Using current time ({dt.isoformat()}) instead of old timestamp: {local_ts}")
+            logging.info("Using current time (%s) instead of old timestamp: %s", dt.isoformat(), local_ts)
         
         return dt.astimezone(ZoneInfo('UTC')).strftime('%Y-%m-%dT%H:%M:%S')
     except Exception as e:
-        print(f"[WARN] Error converting timestamp: {e}. Using current UTC time.")
+        logging.warning("Error converting timestamp: %s. Using current UTC time.", e)
         return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
 
 
 def generate_guid(store: str, terminal: str, seq: str, ts_utc: str) -> str:
-    ns = f"{store}-{terminal}-{seq}-{ts_utc}"
-    return str(uuid.uuid5(uuid.NAMESPACE_URL, ns))
+    """UUIDv5 over NAMESPACE_URL, identical to uuid.uuid5() but hashed in one shot."""
+    d = bytearray(hashlib.sha1(_NS_BYTES + f"{store}-{terminal}-{seq}-{ts_utc}".encode()).digest()[:16])
+    d[6] = (d[6] & 0x0F) | 0x50
+    d[8] = (d[8] & 0x3F) | 0x80
+    return str(uuid.UUID(bytes=bytes(d)))
 
 # ─── RAW LOGGING & EVENTS ───
+# Public writers only enqueue; the _do_* functions run on the io_worker thread
+# so serial reads and API dispatch never block on disk.
 
-def log_raw_json(port: str, raw: str):
-    ensure_directories()
-    path = os.path.join(LOG_DIR, f"pos_transactions_{port}.log")
+def io_worker():
+    last_flush = time.monotonic()
+    while True:
+        wait = max(0.0, last_flush + CSV_FLUSH_SECS - time.monotonic())
+        try:
+            fn, args = _io_queue.get(timeout=wait)
+        except queue.Empty:
+            pass
+        else:
+            try:
+                fn(*args)
+            except Exception as e:
+                logging.error("Disk write %s failed: %s", fn.__name__, e)
+            finally:
+                _io_queue.task_done()
+        # Push buffered CSV rows to disk at least every CSV_FLUSH_SECS,
+        # even while the queue never goes quiet
+        if time.monotonic() - last_flush >= CSV_FLUSH_SECS:
+            if _csv_fh is not None:
+                _csv_fh.flush()
+            last_flush = time.monotonic()
+
+
+def log_raw_json(port: str, raw: bytes):
+    # Stamp on arrival, not when the write is drained
     ts = datetime.now(timezone.utc).isoformat()
-    with open(path, 'a', encoding='utf-8') as f:
-        f.write(f"{ts} {raw}\n")
+    _io_queue.put((_do_log_raw_json, (port, raw, ts)))
 
 
 def save_tx_event(tx: dict):
-    ensure_directories()
-    fname = f"{tx['seq']}_{tx['guid']}.json"
-    with open(os.path.join(EVENTS_DIR, fname), 'w', encoding='utf-8') as f:
-        json.dump(tx, f, indent=2)
+    _io_queue.put((_do_save_tx_event, (tx,)))
 
 
 def write_transaction_by_date(tx: dict, success: bool, status_code: int, resp_body: str = ""):
+    _io_queue.put((_do_write_transaction_by_date, (tx, success, status_code, resp_body)))
+
+
+def _do_log_raw_json(port: str, raw: bytes, ts: str):
+    path = os.path.join(LOG_DIR, f"pos_transactions_{port}.log")
+    with open(path, 'ab') as f:
+        f.write(ts.encode() + b' ' + raw + b'\n')
+
+
+def _do_save_tx_event(tx: dict):
+    fname = f"{tx['seq']}_{tx['guid']}.json"
+    with open(os.path.join(EVENTS_DIR, fname), 'wb') as f:
+        f.write(orjson.dumps(tx, option=orjson.OPT_INDENT_2))
+
+
+def _do_write_transaction_by_date(tx: dict, success: bool, status_code: int, resp_body: str = ""):
     ts = tx['ts_utc']
     date = ts.split('T')[0]
     y, m, d = date.split('-')
     base = os.path.join(TRANSACTIONS_DIR, y, m, d)
     sent = os.path.join(base, 'sent')
     failed = os.path.join(base, 'failed')
-    os.makedirs(sent, exist_ok=True)
-    os.makedirs(failed, exist_ok=True)
+    _ensure_dir(sent)
+    _ensure_dir(failed)
     fname = f"{tx['seq']}_{tx['guid']}.json"
     dest = sent if success else failed
-    with open(os.path.join(dest, fname), 'w', encoding='utf-8') as f:
-        json.dump(tx, f, indent=2)
+    with open(os.path.join(dest, fname), 'wb') as f:
+        f.write(orjson.dumps(tx, option=orjson.OPT_INDENT_2))
     logf = os.path.join(dest, 'sent.log' if success else 'failed.log')
     snippet = (resp_body or '')[:200].replace('\n', ' ')
     with open(logf, 'a', encoding='utf-8') as f:
         f.write(f"{datetime.now(timezone.utc).isoformat()} {tx['seq']}_{tx['guid']} {status_code} {snippet}\n")
-    append_csv_report(tx, success, status_code)
+    _do_append_csv_report(tx, success, status_code)
 
-def append_csv_report(tx: dict, success: bool, status_code: int):
+def _do_append_csv_report(tx: dict, success: bool, status_code: int):
     """Append a one-line summary of the transaction to the companion CSV."""
     row = [
         tx.get('ts_utc', ''),
@@ -182,29 +329,41 @@ def append_csv_report(tx: dict, success: bool, status_code: int):
         'success' if success else 'failed',
         status_code
     ]
-    file_exists = os.path.isfile(CSV_REPORT)
-    with open(CSV_REPORT, 'a', newline='', encoding='utf-8') as csvfile:
-        writer = csv.writer(csvfile)
-        if not file_exists:
-            writer.writerow(['ts_utc', 'guid', 'store', 'terminal', 'seq', 'type', 'result', 'status_code'])
-        writer.writerow(row)
+    _csv_writer.writerow(row)
 
 # ─── TENDER MAPPING ───
 
+# Checked in order; the first keyword found in the description wins
+TENDER_MAP = {
+    'CASH': 'Cash',
+    'VISA': 'CreditCard',
+    'MASTERCARD': 'CreditCard',
+    'AMEX': 'CreditCard',
+    'DISCOVER': 'CreditCard',
+    'DEBIT': 'DebitCard',
+}
+
 def map_tender(desc: str) -> str:
     d = desc.upper()
-    if 'CASH' in d: return 'Cash'
-    if any(x in d for x in ('VISA','MASTERCARD','AMEX','DISCOVER')): return 'CreditCard'
-    if 'DEBIT' in d: return 'DebitCard'
+    tender = next((v for k, v in TENDER_MAP.items() if k in d), None)
+    if tender: return tender
     if d.startswith(('ACCT#','ACCOUNT')): return 'AccountPayment'
     return 'Other'
 
 # ─── SERIAL-PORT READER ───
 
+def read_exactly(ser, n: int, deadline: float) -> bytes:
+    """Read up to n bytes, looping past pyserial's per-call TIMEOUT until the deadline."""
+    buf = bytearray()
+    while len(buf) < n and time.monotonic() <= deadline:
+        buf += ser.read(n - len(buf))
+    return bytes(buf)
+
+
 def read_from_port(port: str):
     while True:
         try:
-            print(f"[INFO] Opening serial port {port}...")
+            logging.info("Opening serial port %s...", port)
             ser = serial.Serial(
                 port=port,
                 baudrate=BAUDRATE,
@@ -214,27 +373,35 @@ def read_from_port(port: str):
                 rtscts=RTSCTS,
                 timeout=TIMEOUT
             )
-            print(f"[INFO] Listening on {port}...")
+            logging.info("Listening on %s...", port)
+            buf = bytearray()
             while True:
-                hdr = ser.readline().decode('utf-8', errors='replace').strip()
-                m = HEADER_PATTERN.match(hdr)
-                if not m:
-                    continue
-                length = int(m.group(1))
-                data = ser.read(length)
-                try:
-                    txt = data.decode('utf-8', errors='replace')
-                except:
-                    txt = data.decode('latin1', errors='ignore')
-                log_raw_json(port, txt)
-                try:
-                    rec = json.loads(txt)
-                except json.JSONDecodeError:
-                    print(f"[WARN] Invalid JSON on {port}: {txt[:80]}…")
-                    continue
-                parser_queue.put((port, rec))
+                # Pull whatever the driver has buffered in one call instead of
+                # readline()'s byte-at-a-time loop.
+                buf += ser.read(max(ser.in_waiting, 1))
+                while True:
+                    nl = buf.find(b'\n')
+                    if nl < 0:
+                        break
+                    hdr = buf[:nl].strip()
+                    size = hdr[len(HEADER_PREFIX):]
+                    if not (hdr.startswith(HEADER_PREFIX) and size.isdigit()):
+                        del buf[:nl + 1]
+                        continue
+                    length = int(size)
+                    end = nl + 1 + length
+                    data = bytes(buf[nl + 1:end])
+                    del buf[:end]
+                    if len(data) < length:
+                        # Allow for the wire time of the rest of the payload (10 bits per byte).
+                        deadline = time.monotonic() + max(2.0, length / (BAUDRATE / 10))
+                        data += read_exactly(ser, length - len(data), deadline)
+                        if len(data) < length:
+                            logging.warning("Short read on %s: got %s of %s bytes", port, len(data), length)
+                    log_raw_json(port, data)
+                    parser_queue.put((port, data))
         except Exception as e:
-            print(f"[ERROR] Port {port}: {e}. Retrying in 5s...")
+            logging.error("Port %s: %s. Retrying in 5s...", port, e)
             time.sleep(5)
         finally:
             try:
@@ -246,116 +413,147 @@ def read_from_port(port: str):
 
 buffers = {p: None for p in SERIAL_PORTS}
 
+def parse_record(raw: bytes):
+    """Decode one POS payload; malformed UTF-8 is replaced rather than rejected."""
+    try:
+        return orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return orjson.loads(raw.decode('utf-8', errors='replace'))
+
+
+def _as_list(raw):
+    """Sub-records may arrive as a JSON string and as a single object or a list."""
+    val = orjson.loads(raw) if isinstance(raw, str) else raw
+    return [val] if isinstance(val, dict) else val
+
+
+def _handle_meta(buf: dict, raw):
+    buf['meta'] = raw
+
+
+def _handle_cart(buf: dict, raw):
+    for c in _as_list(raw):
+        et = c.get('eventType')
+        nm = c.get('itemName', '')
+        pr = float(c.get('price', 0.0)) if c.get('price') is not None else 0.0
+        qt = int(c.get('quantity', 1)) if c.get('quantity') is not None else 1
+        entry = {
+            'name': nm,
+            'price': pr,
+            'quantity': qt,
+            'event': 'void' if et == 'voidLineItem' else 'add'
+        }
+        (buf['voids' if entry['event'] == 'void' else 'items']).append(entry)
+
+
+def _handle_pay(buf: dict, raw):
+    for p in _as_list(raw):
+        amt = float(p.get('details', '0').translate(MONEY_STRIP))
+        buf['payments'].append({'amount': amt, 'tenderType': p.get('description', '')})
+
+
+def _handle_summary(buf: dict, raw):
+    summ = _as_list(raw)
+    buf['summary_list'] = summ
+    smap = {}
+    for e in summ:
+        key = e.get('description', '').upper().strip()
+        val_str = e.get('details', '').translate(MONEY_STRIP).strip()
+        try:
+            val = float(val_str)
+        except:
+            val = 0.0
+        smap[key] = val
+    buf['summary_map'] = smap
+
+
+# Record body key -> handler, checked in this order; the POS sends one of these per message
+_HANDLERS = {
+    'metaData': _handle_meta,
+    'cartChangeTrail': _handle_cart,
+    'paymentSummary': _handle_pay,
+    'transactionSummary': _handle_summary,
+}
+
+
+def _finish_transaction(buf: dict):
+    m = buf['meta'] or {}
+    ts_loc = m.get('timeStamp', '')
+    ts_utc = to_utc(ts_loc) if ts_loc else ''
+    seq   = str(m.get('transactionSeqNumber', ''))
+    store = '1001'
+    term  = str(m.get('terminalNumber', ''))
+    op    = m.get('operator', '')
+    guid  = generate_guid(store, term, seq, ts_utc)
+    tx = {
+        'guid': guid,
+        'ts_local': ts_loc,
+        'ts_utc': ts_utc,
+        'store': store,
+        'terminal': term,
+        'seq': seq,
+        'type': m.get('transactionType', ''),
+        'items': buf['items'],
+        'voids': buf['voids'],
+        'payments': buf['payments'],
+        'transactionSummary': buf['summary_list'],
+        'summary_map': buf['summary_map'],
+        'employee_id': op,
+        'employee_name': op,
+        'location_desc': f"Store {store}"}
+    save_tx_event(tx)
+    tx_queue.put(tx)
+
+
 def parser_worker():
     while True:
-        port, rec = parser_queue.get()
-        cmd = rec.get('CMD')
-        # StartTransaction
-        if cmd == 'StartTransaction':
-            buffers[port] = {
-                'meta': None,
-                'items': [],
-                'voids': [],
-                'payments': [],
-                'summary_list': [],
-                'summary_map': {}
-            }
-            parser_queue.task_done()
-            continue
-        buf = buffers.get(port)
-        if buf is None:
-            parser_queue.task_done()
-            continue
-        # metaData
-        if rec.get('metaData'):
-            buf['meta'] = rec['metaData']
-            parser_queue.task_done()
-            continue
-        # cartChangeTrail
-        if rec.get('cartChangeTrail') is not None:
-            raw = rec['cartChangeTrail']
-            trail = json.loads(raw) if isinstance(raw, str) else raw
-            if isinstance(trail, dict):
-                trail = [trail]
-            for c in trail:
-                et = c.get('eventType')
-                nm = c.get('itemName', '')
-                pr = float(c.get('price', 0.0)) if c.get('price') is not None else 0.0
-                qt = int(c.get('quantity', 1)) if c.get('quantity') is not None else 1
-                entry = {
-                    'name': nm,
-                    'price': pr,
-                    'quantity': qt,
-                    'event': 'void' if et == 'voidLineItem' else 'add'
+        port, raw = parser_queue.get()
+        try:
+            try:
+                rec = parse_record(raw)
+            except orjson.JSONDecodeError:
+                logging.warning("Invalid JSON on %s: %s…", port, raw[:80].decode('utf-8', errors='replace'))
+                continue
+            cmd = rec.get('CMD')
+            if cmd == 'StartTransaction':
+                buffers[port] = {
+                    'meta': None,
+                    'items': [],
+                    'voids': [],
+                    'payments': [],
+                    'summary_list': [],
+                    'summary_map': {}
                 }
-                (buf['voids' if entry['event'] == 'void' else 'items']).append(entry)
-            parser_queue.task_done()
-            continue
-        # paymentSummary
-        if rec.get('paymentSummary') is not None:
-            raw = rec['paymentSummary']
-            pays = json.loads(raw) if isinstance(raw, str) else raw
-            if isinstance(pays, dict):
-                pays = [pays]
-            for p in pays:
-                amt = float(p.get('details', '0').replace('$', ''))
-                buf['payments'].append({'amount': amt, 'tenderType': p.get('description', '')})
-            parser_queue.task_done()
-            continue
-        # transactionSummary
-        if rec.get('transactionSummary') is not None:
-            raw = rec['transactionSummary']
-            summ = json.loads(raw) if isinstance(raw, str) else raw
-            if isinstance(summ, dict):
-                summ = [summ]
-            buf['summary_list'] = summ
-            smap = {}
-            for e in summ:
-                key = e.get('description', '').upper().strip()
-                val_str = e.get('details', '').replace('$', '').replace(',', '').strip()
-                try:
-                    val = float(val_str)
-                except:
-                    val = 0.0
-                smap[key] = val
-            buf['summary_map'] = smap
-            parser_queue.task_done()
-            continue
-        # EndTransaction
-        if cmd == 'EndTransaction':
-            m = buf['meta'] or {}
-            ts_loc = m.get('timeStamp', '')
-            ts_utc = to_utc(ts_loc) if ts_loc else ''
-            seq   = str(m.get('transactionSeqNumber', ''))
-            store = '1001'
-            term  = str(m.get('terminalNumber', ''))
-            op    = m.get('operator', '')
-            guid  = generate_guid(store, term, seq, ts_utc)
-            tx = {
-                'guid': guid,
-                'ts_local': ts_loc,
-                'ts_utc': ts_utc,
-                'store': store,
-                'terminal': term,
-                'seq': seq,
-                'type': m.get('transactionType', ''),
-                'items': buf['items'],
-                'voids': buf['voids'],
-                'payments': buf['payments'],
-                'transactionSummary': buf['summary_list'],
-                'summary_map': buf['summary_map'],
-                'employee_id': op,
-                'employee_name': op,
-                'location_desc': f"Store {store}"}
-            save_tx_event(tx)
-            tx_queue.put(tx)
-            buffers[port] = None
+                continue
+            buf = buffers.get(port)
+            if buf is None:
+                continue
+            for key, handler in _HANDLERS.items():
+                val = rec.get(key)
+                # An empty metaData falls through, as it always has, so it can't
+                # swallow an EndTransaction in the same record
+                if val is None or (key == 'metaData' and not val):
+                    continue
+                handler(buf, val)
+                break
+            else:
+                if cmd == 'EndTransaction':
+                    _finish_transaction(buf)
+                    buffers[port] = None
+        finally:
             parser_queue.task_done()
-            continue
-        parser_queue.task_done()
 
 # ─── PAYLOAD BUILDERS ───
 
+def event_refs(tx: dict) -> dict:
+    """Location/device/employee sub-models shared by every payload type."""
+    return {
+        'Location': {'LocationID': tx['store'], 'Description': tx['location_desc']},
+        'TransactionDevice': {'DeviceID': tx['terminal'], 'DeviceDescription': f"POS Terminal {tx['terminal']}"},
+        'Employee': {'EmployeeID': tx['employee_id'], 'EmployeeFullName': tx['employee_name']},
+    }
+
+
 def build_cash_op_payload(tx: dict) -> dict:
     ts = tx['ts_utc']
     biz = ts[:10].replace('-', '')
@@ -367,9 +565,7 @@ def build_cash_op_payload(tx: dict) -> dict:
             'TransactionDateTimeStamp': ts,
             'TransactionType': 'New',
             'BusinessDate': biz,
-            'Location': {'LocationID': tx['store'], 'Description': tx['location_desc']},
-            'TransactionDevice': {'DeviceID': tx['terminal'], 'DeviceDescription': f"POS Terminal {tx['terminal']}"},
-            'Employee': {'EmployeeID': tx['employee_id'], 'EmployeeFullName': tx['employee_name']},
+            **event_refs(tx),
             'EventTypeDrawer': {
                 'Drawer': {
                     'DrawerEventGUID': tx['guid'],
@@ -383,88 +579,99 @@ def build_cash_op_payload(tx: dict) -> dict:
     }
 
 
+def _is_promo_name(name: str) -> bool:
+    name = name.upper()
+    return 'PROMO' in name or 'DISCOUNT' in name
+
+
+def _is_promo(itm: dict) -> bool:
+    """Non-voided PROMO/DISCOUNT lines are reported as order discounts, not items."""
+    return itm['event'] != 'void' and _is_promo_name(itm['name'])
+
+
+def _build_item(itm: dict, idx: int, ts: str, seq: str) -> dict:
+    is_void = itm['event'] == 'void'
+    pid     = f"PID{seq}_{idx}"
+    sku     = { 'productName': itm['name'], 'productCode': pid }
+    return {
+        'OrderItemState': [{ 'ItemState': {'value': 'Voided' if is_void else 'Added'}, 'Timestamp': ts }],
+        'MenuProduct': {
+            'menuProductID': pid,
+            'name': itm['name'],
+            'MenuItem': [{
+                'ItemType': 'Voided' if is_void else 'Sale',
+                'Category': 'General',
+                'iD': f"{pid}_MI",
+                'Description': itm['name'],
+                'Pricing': [{
+                    'Tax': [],
+                    'ItemPrice': float(Decimal(itm['price']).quantize(_Q2, _HALF_UP)),
+                    'Quantity': itm['quantity']
+                }],
+                'SKU': sku
+            }],
+            'SKU': sku
+        }
+    }
+
+
 def build_txn_payload(tx: dict) -> dict:
     sm = tx['summary_map']
     subtotal = sm.get('SUBTOTAL', 0.0)
     tax_amt  = next((v for k, v in sm.items() if k.startswith('TAX')), 0.0)
     total_due= sm.get('TOTAL DUE', subtotal + tax_amt)
-    net_item = Decimal(subtotal).quantize(Decimal('0.01'), ROUND_HALF_UP)
-    tax_d    = Decimal(tax_amt).quantize(Decimal('0.01'), ROUND_HALF_UP)
-    tot_due  = Decimal(total_due).quantize(Decimal('0.01'), ROUND_HALF_UP)
-    paid     = sum(p['amount'] for p in tx['payments'] if p['amount'] > 0)
-    paid_d   = Decimal(paid).quantize(Decimal('0.01'), ROUND_HALF_UP)
-    change   = (paid_d - tot_due).quantize(Decimal('0.01'), ROUND_HALF_UP)
-
+    net_item = Decimal(subtotal).quantize(_Q2, _HALF_UP)
+    tax_d    = Decimal(tax_amt).quantize(_Q2, _HALF_UP)
+    tot_due  = Decimal(total_due).quantize(_Q2, _HALF_UP)
+    all_items  = tx['items'] + tx['voids']
     items_list = []
     promotions = []
-    idx = 1
-    for itm in tx['items'] + tx['voids']:
-        is_void = itm['event'] == 'void'
-        state   = 'Voided' if is_void else 'Added'
-        typ     = 'Voided' if is_void else 'Sale'
-        pid     = f"PID{tx['seq']}_{idx}"
-        idx += 1
-
-        is_promo = 'PROMO' in itm['name'].upper() or 'DISCOUNT' in itm['name'].upper()
-        if is_promo and not is_void:
-            promo_val = round(abs(itm['price'] * itm['quantity']), 2)
+    # One pass: each line is checked once and lands in items or promotions
+    for i, itm in enumerate(all_items, 1):
+        if _is_promo(itm):
             promotions.append({
-                'Value': promo_val,
+                'Value': round(abs(itm['price'] * itm['quantity']), 2),
                 'Description': itm['name'],
                 'Category': 'Promotion'
             })
-            continue
-
-        items_list.append({
-            'OrderItemState': [{ 'ItemState': {'value': state}, 'Timestamp': tx['ts_utc'] }],
-            'MenuProduct': {
-                'menuProductID': pid,
-                'name': itm['name'],
-                'MenuItem': [{
-                    'ItemType': typ,
-                    'Category': 'General',
-                    'iD': f"{pid}_MI",
-                    'Description': itm['name'],
-                    'Pricing': [{
-                        'Tax': [],
-                        'ItemPrice': float(Decimal(itm['price']).quantize(Decimal('0.01'), ROUND_HALF_UP)),
-                        'Quantity': itm['quantity']
-                    }],
-                    'SKU': { 'productName': itm['name'], 'productCode': pid }
-                }],
-                'SKU': { 'productName': itm['name'], 'productCode': pid }
-            }
-        })
+        else:
+            items_list.append(_build_item(itm, i, tx['ts_utc'], tx['seq']))
 
+    # One walk over the payments: total what was tendered and build the entries;
+    # change is known only at the end, so it is patched onto the first entry.
+    paid     = 0.0
     payments = []
-    pi = 0
     for p in tx['payments']:
-        amt = Decimal(p['amount']).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        raw = p['amount']
+        if raw > 0:
+            paid += raw
+        amt = Decimal(raw).quantize(_Q2, _HALF_UP)
         if amt == 0:
             continue
-        ch = float(change) if pi == 0 else 0.0
         payments.append({
             'Timestamp': tx['ts_utc'], 'Status': 'Accepted' if amt >= 0 else 'Denied',
-            'Amount': float(amt), 'Change': ch,
+            'Amount': float(amt), 'Change': 0.0,
             'TenderType': {'value': map_tender(p['tenderType'])}
         })
-        pi += 1
+    if payments:
+        paid_d = Decimal(paid).quantize(_Q2, _HALF_UP)
+        payments[0]['Change'] = float((paid_d - tot_due).quantize(_Q2, _HALF_UP))
 
     tax_arr = [{ 'amount': float(tax_d), 'Description': 'Sales Tax' }] if tax_d > 0 else []
     has_voids = bool(tx['voids'])
-    all_voided = has_voids and all(item['event'] == 'void' for item in tx['items'] + tx['voids'])
+    all_voided = has_voids and all(item['event'] == 'void' for item in all_items)
     order_state = 'Voided' if all_voided else 'Closed'
     transaction_type = 'Update' if has_voids else 'New'
-    current_ts = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    now = datetime.now(timezone.utc)
+    current_ts = now.isoformat(timespec='seconds')[:19]  # drop the '+00:00' suffix
+    biz = f"{now.year:04d}{now.month:02d}{now.day:02d}"
 
     evt = {
         'TransactionGUID': tx['guid'],
         'TransactionDateTimeStamp': current_ts,
         'TransactionType': transaction_type,
-        'BusinessDate': current_ts[:10].replace('-', ''),
-        'Location': {'LocationID': tx['store'], 'Description': tx['location_desc']},
-        'TransactionDevice': {'DeviceID': tx['terminal'], 'DeviceDescription': f"POS Terminal {tx['terminal']}"},
-        'Employee': {'EmployeeID': tx['employee_id'], 'EmployeeFullName': tx['employee_name']},
+        'BusinessDate': biz,
+        **event_refs(tx),
         'EventTypeOrder': {
             'Order': {
                 'OrderID': tx['guid'],
@@ -491,7 +698,7 @@ def build_refund_payload(tx: dict) -> dict:
     biz= ts[:10].replace('-', '')
     items_list=[]; idx=1; raw_sub=Decimal('0.00')
     for itm in tx['items']:
-        price = Decimal(itm['price']).quantize(Decimal('0.01'), ROUND_HALF_UP)
+        price = Decimal(itm['price']).quantize(_Q2, _HALF_UP)
         pid   = f"{tx['seq']}_{idx}"; idx+=1
         items_list.append({
             'OrderItemState': [{ 'ItemState': {'value': 'Added'}, 'Timestamp': ts }],
@@ -507,10 +714,11 @@ def build_refund_payload(tx: dict) -> dict:
             }
         })
         raw_sub += price * itm['quantity']
-    refund_total = sum(p['amount'] for p in tx['payments'])
+    refund_total = 0
     payments=[]
     for p in tx['payments']:
         amt = p['amount']
+        refund_total += amt
         if amt == 0: continue
         payments.append({
             'Timestamp': ts, 'Status': 'Accepted', 'Amount': amt, 'Change': 0.0,
@@ -519,7 +727,7 @@ def build_refund_payload(tx: dict) -> dict:
     order={
         'OrderID': tx['guid'], 'OrderNumber': int(tx['seq'] or 0), 'OrderTime': ts,
         'OrderState': 'Closed', 'OrderItem': items_list,
-        'Total': { 'ItemPrice': float(raw_sub.quantize(Decimal('0.01'), ROUND_HALF_UP)), 'Tax': [] },
+        'Total': { 'ItemPrice': float(raw_sub.quantize(_Q2, _HALF_UP)), 'Tax': [] },
         'OrderItemCount': len(items_list), 'Payment': payments
     }
     return {
@@ -529,89 +737,104 @@ def build_refund_payload(tx: dict) -> dict:
             'TransactionDateTimeStamp': ts,
             'TransactionType': 'New',
             'BusinessDate': biz,
-            'Location': {'LocationID': tx['store'], 'Description': tx['location_desc']},
-            'TransactionDevice': {'DeviceID': tx['terminal'], 'DeviceDescription': f"POS Terminal {tx['terminal']}"},
-            'Employee': {'EmployeeID': tx['employee_id'], 'EmployeeFullName': tx['employee_name']},
+            **event_refs(tx),
             'EventTypeRefund': { 'Refund': { 'RefundTotal': refund_total, 'RefundTransactionType': { 'Order': order } } }
         }
     }
 
 # ─── DISPATCHER ───
 
-def dispatcher_worker():
-    while True:
-        tx = tx_queue.get()
+def send_transaction(tx: dict):
+    # Classify transaction type for appropriate URL and logging
+    transaction_category = "unknown"
+    
+    if not tx['items'] and not tx['payments']:
+        payload = build_cash_op_payload(tx)
+        url = CASH_URL
+        transaction_category = "cash-operation"
         
-        # Classify transaction type for appropriate URL and logging
-        transaction_category = "unknown"
+    elif tx['type'].lower() == 'refund':
+        payload = build_refund_payload(tx)
+        url = REFUND_URL
+        transaction_category = "refund"
         
-        if not tx['items'] and not tx['payments']:
-            payload = build_cash_op_payload(tx)
-            url = CASH_URL
-            transaction_category = "cash-operation"
-            
-        elif tx['type'].lower() == 'refund':
-            payload = build_refund_payload(tx)
-            url = REFUND_URL
-            transaction_category = "refund"
-            
+    else:
+        # Standard transaction
+        payload = build_txn_payload(tx)
+        url = TXN_URL
+        
+        # Categorize the transaction for better logging
+        has_voids = bool(tx['voids'])
+        all_voided = has_voids and all(item['event'] == 'void' for item in tx['items'] + tx['voids'])
+        has_promos = any(_is_promo_name(item['name']) or item['price'] < 0 for item in tx['items'])
+        
+        if all_voided:
+            transaction_category = "full-void"
+        elif has_voids:
+            transaction_category = "partial-void"
+        elif has_promos:
+            transaction_category = "promotion"
         else:
-            # Standard transaction
-            payload = build_txn_payload(tx)
-            url = TXN_URL
-            
-            # Categorize the transaction for better logging
-            has_voids = bool(tx['voids'])
-            all_voided = has_voids and all(item['event'] == 'void' for item in tx['items'] + tx['voids'])
-            has_promos = any('PROMO' in item['name'].upper() or item['price'] < 0 for item in tx['items'])
-            
-            if all_voided:
-                transaction_category = "full-void"
-            elif has_voids:
-                transaction_category = "partial-void"
-            elif has_promos:
-                transaction_category = "promotion"
-            else:
-                transaction_category = "standard-sale"
+            transaction_category = "standard-sale"
+    
+    # Log what we're sending
+    logging.info("Sending %s transaction to %s endpoint", transaction_category, url.split('/')[-1])
+    
+    # Make the API request
+    try:
+        token = _token_data['access_token'] or refresh_token_now(None)
+        headers = {**API_HEADERS, 'Authorization': f"Bearer {token}"}
         
-        # Log what we're sending
-        print(f"\n[INFO] Sending {transaction_category} transaction to {url.split('/')[-1]} endpoint")
+        # Send the payload to the API, serialized once up front
+        logging.info("Request payload type: %s", payload['model'])
+        data = orjson.dumps(payload)
+        resp = _session.post(url, headers=headers, data=data, timeout=10)
+        if resp.status_code == 401:
+            # Token was revoked or expired early; refresh once and retry
+            logging.warning("Token rejected (401); refreshing and retrying...")
+            headers['Authorization'] = f"Bearer {refresh_token_now(token)}"
+            resp = _session.post(url, headers=headers, data=data, timeout=10)
+        status_code = resp.status_code
+        body = resp.text
         
-        # Make the API request
-        try:
-            token = fetch_token()
-            headers = {
-                'Authorization': f"Bearer {token}",
-                'External-Party-ID': CLIENT_ID,
-                'Content-Type': 'application/json'
-            }
-            
-            # Send the payload to the API
-            print(f"[INFO] Request payload type: {payload['model']}")
-            resp = requests.post(url, headers=headers, json=payload, timeout=10)
-            status_code = resp.status_code
-            body = resp.text
-            
-            # Log the result
-            if 200 <= status_code < 300:
-                print(f"[SUCCESS] {transaction_category.upper()} transaction sent successfully: Status {status_code}")
-            else:
-                print(f"[ERROR] Failed to send {transaction_category} transaction: Status {status_code}")
-                print(f"[ERROR] Response body: {body[:200]}...")
-                
-        except Exception as e:
-            status_code = 0
-            body = str(e)
-            print(f"[ERROR] Exception sending {transaction_category} transaction: {e}")
+        # Log the result
+        if 200 <= status_code < 300:
+            logging.info("%s transaction sent successfully: Status %s", transaction_category.upper(), status_code)
+        else:
+            logging.error("Failed to send %s transaction: Status %s", transaction_category, status_code)
+            logging.error("Response body: %s...", body[:200])
             
-        # Record the result
-        success = 200 <= status_code < 300
-        write_transaction_by_date(tx, success, status_code, body)
-        tx_queue.task_done()
+    except Exception as e:
+        status_code = 0
+        body = str(e)
+        logging.error("Exception sending %s transaction: %s", transaction_category, e)
+        
+    # Record the result
+    success = 200 <= status_code < 300
+    write_transaction_by_date(tx, success, status_code, body)
+
+
+def _send_done(fut):
+    _in_flight.release()
+    tx_queue.task_done()
+    if fut.exception() is not None:
+        logging.error("Dispatch failed: %s", fut.exception())
+
+
+def dispatcher_worker():
+    while True:
+        tx = tx_queue.get()
+        # Bounded hand-off: wait here rather than queue unbounded work in the pool
+        _in_flight.acquire()
+        _executor.submit(send_transaction, tx).add_done_callback(_send_done)
 
 # ─── MAIN ───
 if __name__ == '__main__':
+    setup_logging()
     ensure_directories()
+    open_csv_report()
+    threading.Thread(target=io_worker, daemon=True).start()
+    threading.Thread(target=token_refresher, daemon=True).start()
     threading.Thread(target=parser_worker, daemon=True).start()
     threading.Thread(target=dispatcher_worker, daemon=True).start()
     for port in SERIAL_PORTS:
@@ -620,4 +843,5 @@ if __name__ == '__main__':
         while True:
             time.sleep(10)
     except KeyboardInterrupt:
-        print("[INFO] Shutting down...")
\ No newline at end of file
+        logging.info("Shutting down...")
+        _io_queue.join()
\ No newline at end of file
@@ -5,44 +5,134 @@ Based on COM4 Transaction 0877 with correct timing and structure
 Portal shows proper PRODUCTS and DISCOUNTS sections
 """
 
+import asyncio
+import datetime
+import gzip
 import logging
+import socket
+import sys
+import time
 import uuid
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 from api_client import APIClient
 from config import Config
 
+try:
+    import httpx  # optional, only needed by send_transactions_batch()
+except ImportError:
+    httpx = None
+
+try:
+    import h2  # noqa: F401  httpx's HTTP/2 support ('httpx[http2]' extra)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
 # Configure logging
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
+IDENTITY_BASE_URL = 'https://identity-qa.go360iq.com'
+DATA_API_BASE_URL = 'https://data-api-uat.go360iq.com'
+TRANSACTIONS_URL = f'{DATA_API_BASE_URL}/v1/Transactions'
+
+CONNECT_TIMEOUT, READ_TIMEOUT = 5, 30
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+# Opt-in: the 360iQ docs don't mention gzip request bodies. When enabled,
+# bodies above GZIP_MIN_BYTES are compressed, and gzip is switched off for the
+# rest of the run if the Data API rejects one with 400 or 415
+GZIP_MIN_BYTES = 1024
+GZIP_REQUESTS = False
+
+# Sent with every Data API request, so caller-supplied sessions get them too
+API_HEADERS = {
+    'External-Party-ID': 'externalPartner_NSRPetrol',
+    'Content-Type': 'application/json'
+}
+
+# OS-level keep-alive probes so idle pooled connections are detected as dead
+# before they are reused (the TCP_KEEP* tunables are not available everywhere)
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+] + [(socket.IPPROTO_TCP, getattr(socket, name), value)
+     for name, value in (('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 30),
+                         ('TCP_KEEPCNT', 3)) if hasattr(socket, name)]
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter whose pooled sockets have TCP keep-alive enabled"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = KEEPALIVE_SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+
+SESSION = None
+_TOKEN_CACHE = {'token': None, 'expires_at': 0.0, 'session_token': None}
+
+
+def _get_session() -> requests.Session:
+    """Return the shared session so repeated calls reuse keep-alive connections"""
+    global SESSION
+    if SESSION is None:
+        SESSION = requests.Session()
+        # POST is outside Retry's default allowed_methods, so transaction
+        # posts are only retried when the connection cannot be established;
+        # 5xx/read-timeout retries would risk duplicating a transaction.
+        adapter = KeepAliveAdapter(pool_connections=4,
+                                   pool_maxsize=16,
+                                   max_retries=Retry(
+                                       total=3,
+                                       backoff_factor=0.2,
+                                       status_forcelist=[502, 503, 504]))
+        SESSION.mount(IDENTITY_BASE_URL, adapter)
+        SESSION.mount(DATA_API_BASE_URL, adapter)
+        SESSION.headers.update(API_HEADERS)
+    return SESSION
+
+
+_BANNER = "\n".join([
+    "=" * 80,
+    "TEST TRANSACTION 4214 - ACCURATE MAPPING FROM PORTAL RECEIPT",
+    "=" * 80,
+    "REGISTER TRANSACTION: 0877",
+    "Portal Receipt Data:",
+    "Items:",
+    "  • DM Banana24ct - 2 x $0.89 = $1.78",
+    "  • B&M PT Casino NICE Uprt - 1 x $1.73 = $1.73",
+    "Discounts:",
+    "  • PROMO EVD Bananas - $0.78",
+    "Subtotal: $3.51",
+    "Tax: $0.11",
+    "Total: $2.84",
+    "Payment: Cash $5.00",
+    "Change: $2.16",
+    "=" * 80,
+]) + "\n"
+
 
 def print_banner():
     """Print test banner"""
-    print("=" * 80)
-    print("TEST TRANSACTION 4214 - ACCURATE MAPPING FROM PORTAL RECEIPT")
-    print("=" * 80)
-    print("REGISTER TRANSACTION: 0877")
-    print("Portal Receipt Data:")
-    print("Items:")
-    print("  • DM Banana24ct - 2 x $0.89 = $1.78")
-    print("  • B&M PT Casino NICE Uprt - 1 x $1.73 = $1.73")
-    print("Discounts:")
-    print("  • PROMO EVD Bananas - $0.78")
-    print("Subtotal: $3.51")
-    print("Tax: $0.11")
-    print("Total: $2.84")
-    print("Payment: Cash $5.00")
-    print("Change: $2.16")
-    print("=" * 80)
+    sys.stdout.write(_BANNER)
+
+
+# Receipt time shared by every timestamp slot; orjson serializes the naive
+# datetime as 'YYYY-MM-DDTHH:MM:SS', the same string the API received before
+TRANSACTION_TS = datetime.datetime(2025, 7, 16, 14, 41)
 
 
 def create_transaction_4213():
     """Create transaction 4213 - Based on actual portal receipt from register 0877"""
-    import uuid
-
+    # IDs are uuid.UUID objects; orjson writes the canonical string form
     transaction_data = {
         'Event': {
-            'TransactionGUID': str(uuid.uuid4()),
-            'TransactionDateTimeStamp': '2025-07-16T14:41:00',
+            'TransactionGUID': uuid.uuid4(),
+            'TransactionDateTimeStamp': TRANSACTION_TS,
             'TransactionType': 'New',
             'BusinessDate': '20250715',
             'Location': {
@@ -60,11 +150,11 @@ def create_transaction_4213():
             'EventTypeOrder': {
                 'Order': {
                     'OrderID':
-                    str(uuid.uuid4()),
+                    uuid.uuid4(),
                     'OrderNumber':
                     4214,
                     'OrderTime':
-                    '2025-07-16T14:41:00',
+                    TRANSACTION_TS,
                     'OrderState':
                     'Closed',
                     'OrderItem': [{
@@ -72,7 +162,7 @@ def create_transaction_4213():
                             'ItemState': {
                                 'value': 'Added'
                             },
-                            'Timestamp': '2025-07-16T14:41:00'
+                            'Timestamp': TRANSACTION_TS
                         }],
                         'MenuProduct': {
                             'menuProductID':
@@ -108,7 +198,7 @@ def create_transaction_4213():
                             'ItemState': {
                                 'value': 'Added'
                             },
-                            'Timestamp': '2025-07-16T14:41:00'
+                            'Timestamp': TRANSACTION_TS
                         }],
                         'MenuProduct': {
                             'menuProductID':
@@ -156,7 +246,7 @@ def create_transaction_4213():
                     'OrderItemCount':
                     2,
                     'Payment': [{
-                        'Timestamp': '2025-07-16T14:41:00',
+                        'Timestamp': TRANSACTION_TS,
                         'Status': 'Accepted',
                         'Amount': 5.00,
                         'Change': 2.16,
@@ -172,9 +262,20 @@ def create_transaction_4213():
     return transaction_data
 
 
+def _install_token(access_token: str):
+    """Set the session's Authorization header, only when the token changes"""
+    if _TOKEN_CACHE['session_token'] != access_token:
+        _get_session().headers['Authorization'] = f'Bearer {access_token}'
+        _TOKEN_CACHE['session_token'] = access_token
+
+
 def fetch_token() -> str:
-    """Authenticate with 360iQ Identity API and get access token"""
-    import requests
+    """Authenticate with 360iQ Identity API and get access token
+
+    The token is cached in memory and only refetched within 60s of expiry.
+    """
+    if time.monotonic() < _TOKEN_CACHE['expires_at'] - 60:
+        return _TOKEN_CACHE['token']
 
     # Use the same credentials as the working transactions
     IDENTITY_URL = 'https://identity-qa.go360iq.com/connect/token'
@@ -183,103 +284,223 @@ def fetch_token() -> str:
 
     logging.info("Fetching authentication token...")
 
-    response = requests.post(IDENTITY_URL,
-                             data={
-                                 'grant_type': 'client_credentials',
-                                 'client_id': CLIENT_ID,
-                                 'client_secret': CLIENT_SECRET
-                             },
-                             timeout=10)
+    # Form-encoded body; override the session's JSON Content-Type and
+    # don't send a stale bearer token to the identity service
+    response = _get_session().post(
+        IDENTITY_URL,
+        data={
+            'grant_type': 'client_credentials',
+            'client_id': CLIENT_ID,
+            'client_secret': CLIENT_SECRET
+        },
+        headers={
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Authorization': None
+        },
+        timeout=TIMEOUT)
 
     if response.status_code != 200:
-        logging.error(f"Authentication failed: {response.status_code}")
-        logging.error(f"Response: {response.text}")
+        logging.error("Authentication failed: %s", response.status_code)
+        logging.error("Response: %s", response.text)
         return None
 
     token_data = response.json()
     access_token = token_data['access_token']
     expires_in = token_data.get('expires_in', 3600)
+    _TOKEN_CACHE['token'] = access_token
+    _TOKEN_CACHE['expires_at'] = time.monotonic() + expires_in
+    _install_token(access_token)
 
-    logging.info(
-        f"Authentication successful. Token expires in {expires_in} seconds")
+    logging.info("Authentication successful. Token expires in %s seconds",
+                 expires_in)
     return access_token
 
 
-def send_transaction_to_360iq(transaction_data: dict,
-                              access_token: str) -> bool:
-    """Send transaction to 360iQ Data API"""
+def _post_transaction(body: bytes,
+                      session: requests.Session = None) -> requests.Response:
+    """POST a serialized transaction, compressing large bodies when supported"""
+    global GZIP_REQUESTS
+    session = session or _get_session()
+    if GZIP_REQUESTS and len(body) > GZIP_MIN_BYTES:
+        response = session.post(TRANSACTIONS_URL,
+                                data=gzip.compress(body, compresslevel=1),
+                                headers={
+                                    **API_HEADERS, 'Content-Encoding': 'gzip'
+                                },
+                                timeout=TIMEOUT)
+        if response.status_code not in (400, 415):
+            return response
+        logging.warning(
+            "Data API rejected a gzip request body (%s); sending uncompressed",
+            response.status_code)
+        GZIP_REQUESTS = False
+    return session.post(TRANSACTIONS_URL,
+                        data=body,
+                        headers=API_HEADERS,
+                        timeout=TIMEOUT)
+
+
+def check_data_api() -> bool:
+    """Cheap reachability probe of the Data API before building a transaction"""
     try:
-        import requests
-        import json
+        # Any HTTP status (even 405 for HEAD) means the endpoint is reachable
+        _get_session().head(TRANSACTIONS_URL, timeout=(2, 5))
+        return True
+    except requests.RequestException as e:
+        logging.error("Data API connectivity check failed: %s", e)
+        return False
 
-        headers = {
-            'Authorization': f'Bearer {access_token}',
-            'External-Party-ID': 'externalPartner_NSRPetrol',
-            'Content-Type': 'application/json'
-        }
 
-        logging.info("Sending transaction to 360iQ Data API...")
+def send_transaction_to_360iq(transaction_data: dict,
+                              access_token: str) -> bool:
+    """Send transaction to 360iQ Data API
 
-        response = requests.post(
-            'https://data-api-uat.go360iq.com/v1/Transactions',
-            headers=headers,
-            json=transaction_data,
-            timeout=30)
+    Returns False on connection errors/timeouts or a non-202 success status;
+    4xx/5xx responses raise requests.HTTPError. The POST itself is not retried
+    on 5xx or read timeouts, only when the connection cannot be established.
+    """
+    _install_token(access_token)
 
-        logging.info(f"API Response Status: {response.status_code}")
-        logging.info(f"API Response: {response.text}")
+    logging.info("Sending transaction to 360iQ Data API...")
 
-        if response.status_code == 202:
-            logging.info("Transaction sent successfully!")
-            return True
-        else:
-            logging.error(
-                f"Failed to send transaction: {response.status_code} - {response.text}"
-            )
-            return False
-
-    except Exception as e:
-        logging.error(f"Error sending transaction: {str(e)}")
+    try:
+        # Pre-serialize; the session already sends Content-Type: application/json
+        response = _post_transaction(orjson.dumps(transaction_data))
+    except (requests.ConnectionError, requests.Timeout) as e:
+        logging.error("Error sending transaction: %s", e)
         return False
 
+    logging.info("API Response Status: %s", response.status_code)
+    # Only decode the body when it will actually be logged
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("API Response: %s", response.text)
+
+    if response.status_code == 202:
+        logging.info("Transaction sent successfully!")
+        return True
+
+    logging.error("Failed to send transaction: %s - %s",
+                  response.status_code, response.text)
+    response.raise_for_status()
+    return False
+
+
+def send_transactions(tx_list: list, session: requests.Session = None) -> list:
+    """Send transactions back-to-back over one keep-alive session
+
+    With no session, the shared one is used and authenticated via fetch_token(),
+    raising RuntimeError before anything is sent if authentication fails. A
+    caller-supplied session must already carry its Authorization header; the
+    partner and content-type headers are added per request.
+    The 360iQ rate limit still applies. Returns (status_code, response_text) per
+    transaction, with (0, error) for one that could not be delivered.
+    """
+    if session is None and not fetch_token():
+        raise RuntimeError("Authentication failed; no transactions sent")
+    results = []
+    for transaction_data in tx_list:
+        try:
+            response = _post_transaction(orjson.dumps(transaction_data), session)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logging.error("Error sending transaction: %s", e)
+            results.append((0, str(e)))
+            continue
+        results.append((response.status_code, response.text))
+    return results
+
+
+async def send_transactions_batch(transactions: list,
+                                  access_token: str,
+                                  concurrency: int = 16) -> list:
+    """Send many transactions concurrently over pooled HTTP/2 connections
+
+    Requires httpx; without the h2 package (pip install 'httpx[http2]') the
+    pooled connections use HTTP/1.1 instead.
+    Returns one bool per transaction, in order: True if the API accepted it.
+    """
+    if httpx is None:
+        raise RuntimeError(
+            "send_transactions_batch requires httpx: pip install 'httpx[http2]'")
+    if not HTTP2_AVAILABLE:
+        logging.warning("h2 is not installed; sending the batch over HTTP/1.1")
+
+    headers = {**API_HEADERS, 'Authorization': f'Bearer {access_token}'}
+    limits = httpx.Limits(max_connections=concurrency,
+                          max_keepalive_connections=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(http2=HTTP2_AVAILABLE,
+                                 limits=limits,
+                                 headers=headers,
+                                 timeout=httpx.Timeout(
+                                     READ_TIMEOUT,
+                                     connect=CONNECT_TIMEOUT)) as client:
+
+        async def send_one(transaction_data: dict) -> bool:
+            async with semaphore:
+                try:
+                    response = await client.post(
+                        TRANSACTIONS_URL, content=orjson.dumps(transaction_data))
+                except httpx.HTTPError as e:
+                    logging.error("Error sending transaction: %s", e)
+                    return False
+            if response.status_code != 202:
+                logging.error("Failed to send transaction: %s - %s",
+                              response.status_code, response.text)
+                return False
+            return True
+
+        return await asyncio.gather(*(send_one(t) for t in transactions))
+
 
-def main():
-    """Main function to send test transaction 4213"""
-    print_banner()
+def main(verbose: bool = True):
+    """Main function to send test transaction 4213
 
-    # Authenticate
+    verbose=False skips the banner and transaction summary output.
+    """
+    # Authenticate and check the Data API is up before doing any other work
     access_token = fetch_token()
     if not access_token:
         print("❌ Authentication failed!")
         return
 
+    if not check_data_api():
+        print("❌ 360iQ Data API is unreachable!")
+        return
+
+    if verbose:
+        print_banner()
+
     # Create transaction
     transaction_data = create_transaction_4213()
 
     # Print transaction summary
-    order = transaction_data['Event']['EventTypeOrder']['Order']
-    total = order['Total']
-
-    print("\nTransaction Summary:")
-    print(f"Transaction ID: {transaction_data['Event']['TransactionGUID']}")
-    print(f"Order Number: {order['OrderNumber']}")
-    print(f"Store: {transaction_data['Event']['Location']['LocationID']}")
-    print(
-        f"Terminal: {transaction_data['Event']['TransactionDevice']['DeviceID']}"
-    )
-    print(f"Employee: {transaction_data['Event']['Employee']['EmployeeID']}")
-    print(f"Items: {len(order['OrderItem'])}")
-    print(f"Subtotal: ${total['ItemPrice']:.2f}")
-    print(f"Tax: ${total['Tax'][0]['amount']:.2f}")
-    print(f"Discount: ${total['Discount'][0]['Value']:.2f}")
-    print(f"Total: ${order['Payment'][0]['Amount']:.2f}")
-    print(
-        f"Payment: {order['Payment'][0]['TenderType']['value']} - ${order['Payment'][0]['Amount']:.2f}"
-    )
-    print(f"Change: ${order['Payment'][0]['Change']:.2f}")
+    if verbose:
+        event = transaction_data['Event']
+        order = event['EventTypeOrder']['Order']
+        total = order['Total']
+        payment = order['Payment'][0]
+        sys.stdout.write("\n".join([
+            "\nTransaction Summary:",
+            f"Transaction ID: {event['TransactionGUID']}",
+            f"Order Number: {order['OrderNumber']}",
+            f"Store: {event['Location']['LocationID']}",
+            f"Terminal: {event['TransactionDevice']['DeviceID']}",
+            f"Employee: {event['Employee']['EmployeeID']}",
+            f"Items: {len(order['OrderItem'])}",
+            f"Subtotal: ${total['ItemPrice']:.2f}",
+            f"Tax: ${total['Tax'][0]['amount']:.2f}",
+            f"Discount: ${total['Discount'][0]['Value']:.2f}",
+            f"Total: ${payment['Amount']:.2f}",
+            f"Payment: {payment['TenderType']['value']} - ${payment['Amount']:.2f}",
+            f"Change: ${payment['Change']:.2f}",
+        ]) + "\n")
 
     # Send transaction
-    success = send_transaction_to_360iq(transaction_data, access_token)
+    try:
+        success = send_transaction_to_360iq(transaction_data, access_token)
+    except requests.HTTPError:
+        success = False
 
     if success:
         print(f"\n✓ Transaction 4213 sent successfully!")